@@ -3,10 +3,14 @@ HuggingFace Adapter Implementation
 
 Implements the Adapter interface for local HuggingFace models.
 """
+import hashlib
+import inspect
 import math
 import torch
+from array import array
+from collections import OrderedDict
 import unicodedata
-from typing import List, Literal, Optional
+from typing import Dict, List, Literal, Optional, Sequence, Tuple, Union
 from transformers import AutoTokenizer, AutoModelForCausalLM
 
 from contracts import (
@@ -17,6 +21,28 @@ from contracts import (
 )
 
 
+def _build_display_table() -> dict:
+    """
+    Translation table for make_token_display.
+    
+    Covers every control character (category Cc, U+0000-U+001F and
+    U+007F-U+009F) plus the plain space, so display labels need one
+    str.translate call instead of a per-character category lookup.
+    """
+    table = {}
+    for code_point in range(0xA0):
+        if unicodedata.category(chr(code_point)) == 'Cc':
+            table[code_point] = f'⟦U+{code_point:04X}⟧'
+    table[ord('\n')] = '⏎\\n'
+    table[ord('\t')] = '⇥\\t'
+    table[ord('\r')] = '␍\\r'
+    table[ord(' ')] = '␠'
+    return table
+
+
+_DISPLAY_TABLE = _build_display_table()
+
+
 def make_token_display(raw_text: str) -> str:
     """
     Convert raw token text to a display-safe label.
@@ -43,27 +69,62 @@ def make_token_display(raw_text: str) -> str:
         # Mixed whitespace - show count
         return f'␠×{len(raw_text)}'
     
-    # Replace non-printable control characters first, then whitespace
-    display_chars = []
-    for char in raw_text:
-        cat = unicodedata.category(char)
-        if cat == 'Cc':  # Control character
-            if char == '\n':
-                display_chars.append('⏎\\n')
-            elif char == '\t':
-                display_chars.append('⇥\\t')
-            elif char == '\r':
-                display_chars.append('␍\\r')
-            else:
-                # Format as ⟦U+XXXX⟧
-                code_point = ord(char)
-                display_chars.append(f'⟦U+{code_point:04X}⟧')
-        elif char == ' ':
-            display_chars.append('␠')
-        else:
-            display_chars.append(char)
+    # Replace control characters and spaces in a single C-level pass
+    return raw_text.translate(_DISPLAY_TABLE)
+
+
+# Accepted names for the adapter's dtype argument
+_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def _cpu_supports_bf16() -> bool:
+    """
+    Check whether the CPU has native bfloat16 instructions (AVX-512 BF16 or AMX).
+    
+    oneDNN also runs bf16 on plain AVX-512 CPUs (Skylake-SP, Cascade Lake,
+    Ice Lake) by emulating it, which is slower than float32, so only the real
+    ISA flags count: torch's CPU capability checks when available, the
+    /proc/cpuinfo flags otherwise.
+    """
+    checks = [getattr(torch.cpu, name, None) for name in ("_is_avx512_bf16_supported", "_is_amx_tile_supported")]
+    if all(check is not None for check in checks):
+        return any(check() for check in checks)
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith("flags"):
+                    flags = line.split(":", 1)[1].split()
+                    return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        pass
+    return False
+
+
+def resolve_dtype(dtype: Optional[Union[str, torch.dtype]], device: str) -> torch.dtype:
+    """
+    Resolve the model weight dtype.
     
-    return ''.join(display_chars)
+    - None → float32 (matches the original CPU FP32 setup)
+    - "auto" → bfloat16 on CPUs with native bf16 instructions (float32 otherwise),
+      float16 on CUDA
+    - "float32" / "bfloat16" / "float16" or a torch.dtype → as given
+    """
+    if dtype is None:
+        return torch.float32
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    if dtype == "auto":
+        if device != "cpu":
+            return torch.float16
+        # Without native bf16 instructions oneDNN emulates bf16, slower than fp32
+        return torch.bfloat16 if _cpu_supports_bf16() else torch.float32
+    if dtype not in _DTYPES:
+        raise ValueError(f"Unsupported dtype: {dtype} (expected one of {', '.join(_DTYPES)} or 'auto')")
+    return _DTYPES[dtype]
 
 
 class HuggingFaceAdapter(Adapter):
@@ -77,29 +138,240 @@ class HuggingFaceAdapter(Adapter):
     CONTEXT_CAP_TOKENS = 512  # Context cap: keep last 512 tokens if exceeded
     TOP_K_MIN = 5  # Minimum k value
     TOP_K_MAX = 30  # Maximum k value
+    PREFIX_BLOCK_TOKENS = 16  # Prefix KV cache granularity (tokens per block)
+    PREFIX_CACHE_MAX_TOKENS = 4096  # Prefix KV cache budget (total tokens over all entries)
+    NUCLEUS_WINDOW = 64  # Initial top-k window for the top-p filter (widened as needed)
+    TOKENIZE_CACHE_ENTRIES = 128  # Texts kept in the tokenize() LRU
     
-    def __init__(self, model_name: str, device: str = "cpu"):
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cpu",
+        compile_model: bool = False,
+        dtype: Optional[Union[str, torch.dtype]] = None,
+        quantize: Optional[Literal["int8", "int4"]] = None,
+        use_ipex: bool = False
+    ):
         """
         Initialize the HuggingFace adapter.
         
         Args:
             model_name: HuggingFace model identifier (e.g., "gpt2")
             device: Device to run model on ("cpu" or "cuda")
+            compile_model: If True, wrap the model with torch.compile and warm it up
+            dtype: Weight dtype (see resolve_dtype); default float32.
+                Logits are always cast back to float32 before softmax.
+            quantize: "int8" for int8 weights on the linear layers
+                (bitsandbytes on CUDA, dynamic quantization on CPU), or "int4"
+                for bitsandbytes NF4 weights (CUDA only); default None
+            use_ipex: If True on CPU, optimize the model with Intel Extension for
+                PyTorch (fused kernels, AMX/VNNI) when it is installed
         """
+        if quantize not in (None, "int8", "int4"):
+            raise ValueError(f"Unsupported quantize: {quantize} (expected 'int8', 'int4' or None)")
+        if quantize == "int4" and device == "cpu":
+            raise ValueError("int4 quantization requires a CUDA device (bitsandbytes)")
+        if quantize is not None and use_ipex:
+            raise ValueError("use_ipex can't be combined with quantize")
+        if quantize == "int8" and device == "cpu" and dtype == "auto":
+            # Dynamic int8 quantization quantizes float32 weights
+            dtype = None
         self.model_name = model_name
         self.device = device
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name)
-        # Force CPU FP32: load to CPU, eval()
-        self.model.to(device)
+        self.dtype = resolve_dtype(dtype, device)
+        if quantize == "int8" and device == "cpu" and self.dtype != torch.float32:
+            raise ValueError("int8 quantization on CPU requires dtype float32")
+        # Rust-backed (fast) tokenizer: much faster BPE and provides offset mappings
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if not self.tokenizer.is_fast:
+            print(f"No fast tokenizer available for {model_name}, using the slow Python tokenizer")
+        if quantize is not None and device != "cpu":
+            # bitsandbytes places the quantized weights itself; the model can't be moved afterwards
+            from transformers import BitsAndBytesConfig
+            if quantize == "int4":
+                # NF4 weights, matmuls computed in the adapter dtype
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=self.dtype
+                )
+            else:
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=self.dtype,
+                quantization_config=quantization_config,
+                device_map={"": device}
+            )
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=self.dtype)
+            # Load to device in the requested dtype
+            self.model.to(device=device, dtype=self.dtype)
         self.model.eval()  # Set to evaluation mode
-        # Disable gradients for inference
-        for param in self.model.parameters():
-            param.requires_grad = False
+        if quantize == "int8" and device == "cpu":
+            # int8 weights for nn.Linear; activations are quantized on the fly,
+            # the lm_head output (logits) stays float32
+            torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        # Disable gradients for inference (forward passes also run under inference_mode)
+        self.model.requires_grad_(False)
+        # Newer transformers can compute the LM head for the last position only
+        forward_params = inspect.signature(self.model.forward).parameters
+        self._last_logits_only: Dict[str, int] = {}
+        for name in ("logits_to_keep", "num_logits_to_keep"):
+            if name in forward_params:
+                self._last_logits_only = {name: 1}
+                break
         
         # Ensure pad token is set
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        # Token ids softened by forward_last(soften_newline_eot=True); constant per tokenizer
+        newline_encoded = self.tokenizer.encode('\n', add_special_tokens=False)
+        self._newline_id: Optional[int] = newline_encoded[0] if newline_encoded else None
+        self._eos_id: Optional[int] = self.tokenizer.eos_token_id
+        
+        # Precompute raw/display text for every token id (vocab is fixed)
+        self._build_token_text_cache()
+        
+        # tokenize() can slice token strings out of the text via offsets when the
+        # tokenizer is a fast (Rust) one whose offsets keep leading spaces
+        self._use_offsets = self._offsets_cover_text()
+        
+        # LRU of tokenize() results keyed by text (repeat requests skip the tokenizer)
+        self._tokenize_cache: "OrderedDict[str, Tuple[List[int], Optional[List[Tuple[int, int]]]]]" = OrderedDict()
+        
+        # KV cache of the previous forward pass, the token ids it covers and
+        # their block digests (see _block_digests)
+        self._kv_cache: Optional[Tuple] = None
+        self._cached_ids: List[int] = []
+        self._cached_digests: List[bytes] = []
+        
+        # LRU of earlier forward passes, indexed by every block-aligned prefix
+        # so a new request can reuse any shared prefix (e.g. after switching context)
+        self._prefix_records: "OrderedDict[int, Tuple[List[int], Tuple, List[bytes]]]" = OrderedDict()
+        self._prefix_index: Dict[bytes, int] = {}
+        self._prefix_cache_tokens = 0
+        self._next_record_id = 0
+        
+        # Reusable input_ids buffer (plus a pinned host staging buffer on CUDA)
+        # so forward passes don't allocate a new tensor every step. The event
+        # marks the end of the last async copy out of the staging buffer.
+        self._input_buf = torch.empty((1, self.CONTEXT_CAP_TOKENS), dtype=torch.long, device=device)
+        self._staging_buf: Optional[torch.Tensor] = None
+        self._staging_event: Optional["torch.cuda.Event"] = None
+        if device != "cpu":
+            self._staging_buf = torch.empty(self.CONTEXT_CAP_TOKENS, dtype=torch.long, pin_memory=True)
+            self._staging_event = torch.cuda.Event()
+        
+        if use_ipex and device == "cpu":
+            self._optimize_with_ipex()
+        
+        if compile_model:
+            self._compile_model()
+    
+    def _optimize_with_ipex(self) -> None:
+        """
+        Apply intel_extension_for_pytorch.optimize in the adapter's dtype.
+        
+        IPEX is an optional dependency; without it the model is left as is.
+        """
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            print("intel_extension_for_pytorch not installed, skipping IPEX optimization")
+            return
+        self.model = ipex.optimize(self.model, dtype=self.dtype)
+    
+    def _compile_model(self) -> None:
+        """
+        Compile the model forward with torch.compile (default mode).
+        
+        Not "reduce-overhead": its CUDA graphs overwrite output tensors on the
+        next replay, but past_key_values outputs are kept in the KV caches.
+        Compilation is lazy, so warm up with the real call shapes (prefill,
+        incremental steps on the KV cache, new tokens on a truncated KV cache,
+        batched passes) at two sizes each, which also compiles the
+        dynamic-shape graphs, to keep the compile cost out of the first
+        requests. Falls back to the eager model if compilation is unsupported
+        on this machine.
+        """
+        eager_model = self.model
+        warmup_id = self._eos_id if self._eos_id is not None else 0
+        other_id = 1 if warmup_id == 0 else 0
+        ids = [warmup_id] * 16
+        try:
+            self.model = torch.compile(self.model)
+            for length, gap in ((8, 1), (12, 3)):
+                self._clear_kv_cache()
+                self.forward_last_tensor(ids[:length])  # Prefill
+                self.forward_last_tensor(ids[:length + 1])  # Incremental step on its KV cache
+                self.forward_last_tensor(ids[:length + 2])
+                # One, then several new tokens on a truncated KV cache (edited
+                # context, prefix LRU hit); truncated views keep the strides of
+                # the longer cache, so vary how much is cut off
+                self.forward_last_tensor(ids[:length + 2 - gap] + [other_id])
+                self.forward_last_tensor(ids[:length - gap] + [other_id] * 3)
+            for batch in ([ids[:8], ids[:4]], [ids[:6], ids[:3]], [ids[:6], ids[:3], ids[:8]]):
+                self.forward_last_batch(batch, [False] * len(batch))
+        except Exception as e:
+            print(f"torch.compile failed, using eager model: {e}")
+            self.model = eager_model
+        finally:
+            self._clear_kv_cache()
+    
+    def _clear_kv_cache(self) -> None:
+        """Drop the last-pass KV cache and every prefix cache entry."""
+        self._kv_cache = None
+        self._cached_ids = []
+        self._cached_digests = []
+        self._prefix_records.clear()
+        self._prefix_index.clear()
+        self._prefix_cache_tokens = 0
+    
+    def _build_token_text_cache(self) -> None:
+        """
+        Decode every token id once so topk/choose only do list lookups.
+        
+        Uses len(tokenizer) rather than vocab_size so added special tokens
+        (e.g. Qwen's <|endoftext|>) are covered too.
+        """
+        all_ids = range(len(self.tokenizer))
+        raw_texts = self.tokenizer.batch_decode(
+            [[token_id] for token_id in all_ids],
+            clean_up_tokenization_spaces=False
+        )
+        self._id_to_raw: Tuple[str, ...] = tuple(raw_texts)
+        self._id_to_display: Tuple[str, ...] = tuple(make_token_display(text) for text in raw_texts)
+    
+    def _offsets_cover_text(self) -> bool:
+        """Check that offset slices reproduce the text exactly (fast tokenizer, untrimmed offsets)."""
+        if not self.tokenizer.is_fast:
+            return False
+        probe = " Hello world\n"
+        _, offsets = self._encode(probe)
+        return ''.join(probe[start:end] for start, end in offsets) == probe
+    
+    def _encode(self, text: str) -> Tuple[List[int], List[Tuple[int, int]]]:
+        """One fast-tokenizer call returning only ids and offsets (no attention mask or token type ids)."""
+        encoded = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            return_token_type_ids=False
+        )
+        return encoded["input_ids"], encoded["offset_mapping"]
+    
+    def _token_text(self, token_id: int) -> Tuple[str, str]:
+        """Return (raw, display) text for a token id."""
+        if token_id < len(self._id_to_raw):
+            return self._id_to_raw[token_id], self._id_to_display[token_id]
+        # Model vocab can be padded past the tokenizer (unused ids); decode on demand
+        token_text_raw = self.tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
+        return token_text_raw, make_token_display(token_text_raw)
     
     def tokenize(self, text: str) -> TokenizeResult:
         """
@@ -107,28 +379,79 @@ class HuggingFaceAdapter(Adapter):
         
         Returns {ids, tokens} where:
         - ids: list[int] - token IDs
-        - tokens: list[str] - decoded token strings (preserves leading spaces)
+        - tokens: list[str] - token strings (preserves leading spaces); from the
+          offset mapping on fast tokenizers, decoded per token otherwise
         
         Context cap: if tokenized length > 512, keep last 512 IDs.
         """
-        # Tokenize and get IDs
-        encoded = self.tokenizer.encode(text, add_special_tokens=False)
-        ids = encoded
+        ids, offsets = self._tokenize_cached(text)
+        if offsets is not None:
+            # Fast path: token strings are slices of the input text via the
+            # offset mapping (no per-token decode round-trips)
+            tokens = [text[start:end] for start, end in offsets]
+        else:
+            tokens = self._decode_tokens(ids)
+        
+        # Copy so callers can't mutate the cached entry
+        return {
+            "ids": list(ids),
+            "tokens": tokens
+        }
+    
+    def tokenize_last(self, text: str) -> Tuple[List[int], Optional[int], Optional[str]]:
+        """
+        Tokenize text into token IDs plus the last token's id and text.
+        
+        Same ids and last token as tokenize() (both None for empty text), for
+        callers that only need the last token string: the other token strings
+        are never built.
+        """
+        ids, offsets = self._tokenize_cached(text)
+        if not ids:
+            return [], None, None
+        if offsets is not None:
+            start, end = offsets[-1]
+            last_token_text = text[start:end]
+        else:
+            last_token_text = self._decode_tokens(ids[-1:])[0]
+        # Copy so callers can't mutate the cached entry
+        return list(ids), ids[-1], last_token_text
+    
+    def _tokenize_cached(self, text: str) -> Tuple[List[int], Optional[List[Tuple[int, int]]]]:
+        """
+        Tokenize text into (ids, offsets) capped to the last 512 tokens.
+        
+        offsets is None when the tokenizer's offsets can't be used (see
+        _offsets_cover_text). Results are cached per text (LRU,
+        TOKENIZE_CACHE_ENTRIES).
+        """
+        cached = self._tokenize_cache.get(text)
+        if cached is not None:
+            self._tokenize_cache.move_to_end(text)
+            return cached
+        
+        if self._use_offsets:
+            ids, offsets = self._encode(text)
+        else:
+            ids, offsets = self.tokenizer.encode(text, add_special_tokens=False), None
         
         # Context cap: if tokenized length > 512, keep last 512 IDs
         if len(ids) > self.CONTEXT_CAP_TOKENS:
             ids = ids[-self.CONTEXT_CAP_TOKENS:]
+            if offsets is not None:
+                offsets = offsets[-self.CONTEXT_CAP_TOKENS:]
         
-        # Get exact token strings (preserves leading spaces, etc.)
-        # Recalculate tokens after potential truncation
+        cached = (ids, offsets)
+        self._tokenize_cache[text] = cached
+        if len(self._tokenize_cache) > self.TOKENIZE_CACHE_ENTRIES:
+            self._tokenize_cache.popitem(last=False)
+        return cached
+    
+    def _decode_tokens(self, ids: List[int]) -> List[str]:
+        """Exact per-token strings (preserves leading spaces, etc.) for tokenizers without usable offsets."""
         token_objects = self.tokenizer.convert_ids_to_tokens(ids)
         # Convert token objects to strings, handling special tokens
-        tokens = [self.tokenizer.convert_tokens_to_string([token]) for token in token_objects]
-        
-        return {
-            "ids": ids,
-            "tokens": tokens
-        }
+        return [self.tokenizer.convert_tokens_to_string([token]) for token in token_objects]
     
     def forward_last(self, ids: List[int], soften_newline_eot: bool = False) -> List[float]:
         """
@@ -140,67 +463,368 @@ class HuggingFaceAdapter(Adapter):
         
         Returns vocab-sized list of logits.
         """
+        # Convert to list of floats (contract requires List[float])
+        return self.forward_last_tensor(ids, soften_newline_eot).tolist()
+    
+    def forward_last_tensor(self, ids: List[int], soften_newline_eot: bool = False) -> torch.Tensor:
+        """
+        Same as forward_last, but returns the logits as a 1-D float32 tensor
+        on the model's device.
+        
+        The server passes this straight into topk/choose, which skips boxing
+        the whole vocabulary into Python floats and rebuilding the tensor.
+        """
+        # Fast path: ids is the cached ids plus one new token (the usual /step pattern)
+        cached_ids = self._cached_ids
+        if cached_ids and len(ids) == len(cached_ids) + 1 and ids[:-1] == cached_ids:
+            return self._forward_incremental(ids[-1], soften_newline_eot)
+        
+        # General path: reuse the KV cache for the prefix shared with the previous
+        # call, so only the new tail of ids goes through the model
+        prefix_len = self._cached_prefix_len(ids)
+        block = self.PREFIX_BLOCK_TOKENS
+        digests = self._block_digests(ids, self._cached_digests[:prefix_len // block])
+        
+        # An earlier request may share a longer block-aligned prefix
+        hit = self._lookup_prefix(ids, digests, prefix_len)
+        if hit is not None:
+            prefix_len, past_key_values = hit
+        elif prefix_len > 0:
+            past_key_values = self._kv_cache
+            if prefix_len < len(self._cached_ids):
+                past_key_values = self._truncate_kv_cache(past_key_values, prefix_len)
+        else:
+            past_key_values = None
+        
         # Convert to tensor
-        input_ids = torch.tensor([ids], device=self.device)
-        
-        # Forward pass
-        with torch.no_grad():
-            outputs = self.model(input_ids)
-            logits = outputs.logits[0, -1, :]  # Last position only
-        
-        # Apply soft logit bias if requested
-        if soften_newline_eot:
-            # Identify IDs for '\n' and eos_token_id
-            newline_encoded = self.tokenizer.encode('\n', add_special_tokens=False)
-            newline_id = newline_encoded[0] if newline_encoded else None
-            eos_id = self.tokenizer.eos_token_id
+        input_ids = self._input_ids_tensor(ids[prefix_len:])
+        return self._run_forward(input_ids, past_key_values, ids, digests, soften_newline_eot)
+    
+    def _forward_incremental(self, new_id: int, soften_newline_eot: bool = False) -> torch.Tensor:
+        """
+        Append-one-token fast path: feed only new_id on top of the full KV cache.
+        
+        The caller has checked that the cache covers every id before new_id,
+        so there is no prefix matching or cache truncation to do.
+        """
+        # Reuse the first slot of the input buffer as the length-1 input
+        input_ids = self._input_buf[:, :1]
+        input_ids.fill_(new_id)
+        ids = self._cached_ids + [new_id]
+        digests = self._block_digests(ids, self._cached_digests)
+        return self._run_forward(input_ids, self._kv_cache, ids, digests, soften_newline_eot)
+    
+    def _run_forward(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple],
+        ids: List[int],
+        digests: List[bytes],
+        soften_newline_eot: bool
+    ) -> torch.Tensor:
+        """Run the model on input_ids on top of past_key_values (together they cover ids)."""
+        # Drop the cache first so a failed forward can't leave it out of sync
+        self._kv_cache = None
+        self._cached_ids = []
+        self._cached_digests = []
+        
+        # Forward pass (inference_mode skips autograd view/version tracking).
+        # The logit bias below is an in-place update, which inference tensors
+        # only allow inside inference_mode, so it stays in this block.
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids, past_key_values=past_key_values, use_cache=True, **self._last_logits_only
+            )
+            # Copy out the last position: a view would keep the whole
+            # (1, seq, vocab) logits buffer alive while the handler holds it.
+            # float32 keeps softmax in FP32 when the model runs in bf16/fp16.
+            logits = outputs.logits[0, -1, :].to(torch.float32, copy=True)
             
-            # Subtract ~2.0 from their logits (not -inf)
-            if newline_id is not None:
-                logits[newline_id] -= 2.0
-            if eos_id is not None:
-                logits[eos_id] -= 2.0
+            # Apply soft logit bias if requested
+            if soften_newline_eot:
+                # Subtract ~2.0 from the '\n' and eos_token_id logits (not -inf)
+                if self._newline_id is not None:
+                    logits[self._newline_id] -= 2.0
+                if self._eos_id is not None:
+                    logits[self._eos_id] -= 2.0
         
-        # Convert to list of floats (contract requires List[float])
-        return logits.cpu().tolist()
+        # Keep the cache for the next call (never past the context cap)
+        if len(ids) <= self.CONTEXT_CAP_TOKENS:
+            self._kv_cache = self._to_legacy_kv_cache(outputs.past_key_values)
+            self._cached_ids = list(ids)
+            self._cached_digests = digests
+            self._remember_prefix(self._cached_ids, self._kv_cache, digests)
+        
+        # Stay on the model's device; topk/choose only move the k results to host
+        return logits
+    
+    def _block_digests(self, ids: List[int], known: Sequence[bytes] = ()) -> List[bytes]:
+        """
+        Chained digests of each full PREFIX_BLOCK_TOKENS block of ids.
+        
+        digests[i] identifies ids[:(i + 1) * PREFIX_BLOCK_TOKENS]. `known` must be
+        valid digests for a prefix of ids; only the blocks after it are hashed.
+        """
+        block = self.PREFIX_BLOCK_TOKENS
+        digests = list(known)
+        digest = digests[-1] if digests else b""
+        for end in range((len(digests) + 1) * block, len(ids) + 1, block):
+            block_bytes = array('q', ids[end - block:end]).tobytes()
+            digest = hashlib.blake2b(digest + block_bytes, digest_size=16).digest()
+            digests.append(digest)
+        return digests
     
-    def topk(self, logits: List[float], k: int) -> List[TokenInfo]:
+    def _lookup_prefix(
+        self,
+        ids: List[int],
+        digests: List[bytes],
+        min_len: int
+    ) -> Optional[Tuple[int, Tuple]]:
+        """
+        Find the longest cached block-aligned prefix of ids longer than min_len.
+        
+        Leaves at least one token to feed. Returns (prefix_len, past_key_values)
+        or None.
+        """
+        block = self.PREFIX_BLOCK_TOKENS
+        for index in range((len(ids) - 1) // block - 1, -1, -1):
+            prefix_len = (index + 1) * block
+            if prefix_len <= min_len:
+                break
+            record_id = self._prefix_index.get(digests[index])
+            if record_id is None:
+                continue
+            record_ids, past_key_values, _ = self._prefix_records[record_id]
+            if record_ids[:prefix_len] != ids[:prefix_len]:
+                continue
+            self._prefix_records.move_to_end(record_id)
+            return prefix_len, self._truncate_kv_cache(past_key_values, prefix_len)
+        return None
+    
+    def _remember_prefix(self, ids: List[int], past_key_values: Tuple, digests: List[bytes]) -> None:
+        """Add a forward pass to the prefix LRU and evict the oldest past the token budget."""
+        if not digests:
+            return
+        record_id = self._next_record_id
+        self._next_record_id += 1
+        self._prefix_records[record_id] = (ids, past_key_values, digests)
+        self._prefix_cache_tokens += len(ids)
+        for digest in digests:
+            self._prefix_index[digest] = record_id
+        
+        while self._prefix_cache_tokens > self.PREFIX_CACHE_MAX_TOKENS and len(self._prefix_records) > 1:
+            old_id, (old_ids, _, old_digests) = self._prefix_records.popitem(last=False)
+            self._prefix_cache_tokens -= len(old_ids)
+            for digest in old_digests:
+                if self._prefix_index.get(digest) == old_id:
+                    del self._prefix_index[digest]
+    
+    def forward_last_batch(
+        self,
+        batch_ids: List[List[int]],
+        soften_newline_eot: Sequence[bool]
+    ) -> torch.Tensor:
+        """
+        Batched forward_last_tensor for several independent contexts.
+        
+        Rows are left-padded to the longest context with an attention mask, so
+        the last position of every row is its real last token. Does not read
+        the KV caches, but adds every row's KV to the prefix LRU so the row's
+        next forward_last_tensor call can reuse it.
+        
+        Args:
+            batch_ids: One list of token IDs per row (each non-empty)
+            soften_newline_eot: Per-row flag, same meaning as in forward_last
+        
+        Returns a (batch, vocab) float32 tensor on the model's device.
+        """
+        if not all(batch_ids):
+            raise ValueError("forward_last_batch needs a non-empty ids list for every row")
+        batch_size = len(batch_ids)
+        max_len = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full((batch_size, max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long)
+        for row, ids in enumerate(batch_ids):
+            input_ids[row, max_len - len(ids):] = torch.as_tensor(ids, dtype=torch.long)
+            attention_mask[row, max_len - len(ids):] = 1
+        # Positions start at 0 on each row's first real token, as if unpadded
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                position_ids=position_ids.to(self.device),
+                use_cache=True,
+                **self._last_logits_only
+            )
+            # Last position of every row, copied out of the (batch, seq, vocab)
+            # logits buffer so it can be freed (see _run_forward)
+            logits = outputs.logits[:, -1, :].to(torch.float32, copy=True)
+            
+            # Apply soft logit bias to the rows that asked for it
+            soften_rows = [row for row, soften in enumerate(soften_newline_eot) if soften]
+            if soften_rows:
+                if self._newline_id is not None:
+                    logits[soften_rows, self._newline_id] -= 2.0
+                if self._eos_id is not None:
+                    logits[soften_rows, self._eos_id] -= 2.0
+            
+            # Each row's KV without its padding (positions restart at 0 on the
+            # first real token, so it matches an unpadded pass). Copied here, as
+            # inference tensors like every other cached KV, contiguous like the
+            # caches of incremental passes (so torch.compile reuses their
+            # graphs), and so entries don't keep the padded batch cache alive.
+            past_key_values = self._to_legacy_kv_cache(outputs.past_key_values)
+            row_caches = [
+                (ids, tuple(
+                    tuple(
+                        tensor[row:row + 1, :, max_len - len(ids):, :].clone(memory_format=torch.contiguous_format)
+                        for tensor in layer
+                    )
+                    for layer in past_key_values
+                ))
+                for row, ids in enumerate(batch_ids)
+                if len(ids) <= self.CONTEXT_CAP_TOKENS
+            ]
+        
+        # Add them to the prefix LRU so each row's next step can reuse its prefix
+        for ids, row_kv in row_caches:
+            self._remember_prefix(list(ids), row_kv, self._block_digests(ids))
+        
+        return logits
+    
+    def has_cached_prefix(self, ids: List[int]) -> bool:
+        """
+        Whether forward_last_tensor(ids) can reuse cached KV for at least one
+        PREFIX_BLOCK_TOKENS block of ids (from the last pass or the prefix LRU).
+        
+        Lets the batcher send warm requests down the KV-cache path and batch
+        only the cold prefills.
+        """
+        block = self.PREFIX_BLOCK_TOKENS
+        if self._cached_prefix_len(ids) >= block:
+            return True
+        digests = self._block_digests(ids)
+        for index in range((len(ids) - 1) // block - 1, -1, -1):
+            record_id = self._prefix_index.get(digests[index])
+            if record_id is None:
+                continue
+            prefix_len = (index + 1) * block
+            if self._prefix_records[record_id][0][:prefix_len] == ids[:prefix_len]:
+                return True
+        return False
+    
+    def _input_ids_tensor(self, ids: List[int]) -> torch.Tensor:
+        """Copy ids into the preallocated input buffer and return a (1, n) view of it."""
+        n = len(ids)
+        if n > self.CONTEXT_CAP_TOKENS:
+            return torch.tensor([ids], dtype=torch.long, device=self.device)
+        host_ids = torch.as_tensor(ids, dtype=torch.long)
+        if self._staging_buf is None:
+            self._input_buf[0, :n].copy_(host_ids)
+        else:
+            # The previous non_blocking copy may still be reading the staging
+            # buffer if the GPU lags behind; wait for it before overwriting
+            self._staging_event.synchronize()
+            self._staging_buf[:n].copy_(host_ids)
+            self._input_buf[0, :n].copy_(self._staging_buf[:n], non_blocking=True)
+            self._staging_event.record(torch.cuda.current_stream(self._input_buf.device))
+        return self._input_buf[:, :n]
+    
+    def _cached_prefix_len(self, ids: List[int]) -> int:
+        """
+        Length of the prefix of ids already covered by the KV cache.
+        
+        Capped at len(ids) - 1: the last token always has to be fed to the
+        model to get its logits.
+        """
+        cached_ids = self._cached_ids
+        limit = min(len(cached_ids), len(ids) - 1)
+        if limit <= 0:
+            return 0
+        # Common case: ids extends the cached ids (one list compare in C)
+        if ids[:limit] == cached_ids[:limit]:
+            return limit
+        prefix_len = 0
+        while prefix_len < limit and ids[prefix_len] == cached_ids[prefix_len]:
+            prefix_len += 1
+        return prefix_len
+    
+    @staticmethod
+    def _to_legacy_kv_cache(past_key_values) -> Tuple:
+        """Normalize past_key_values to the tuple-of-(key, value) format."""
+        if hasattr(past_key_values, "to_legacy_cache"):
+            return past_key_values.to_legacy_cache()
+        return past_key_values
+    
+    @staticmethod
+    def _truncate_kv_cache(past_key_values: Tuple, length: int) -> Tuple:
+        """Keep the first `length` positions of a legacy KV cache (views, no copy)."""
+        return tuple(
+            tuple(tensor[:, :, :length, :] for tensor in layer)
+            for layer in past_key_values
+        )
+    
+    def _as_logits_tensor(self, logits: Union[List[float], torch.Tensor]) -> torch.Tensor:
+        """Accept logits from forward_last (list) or forward_last_tensor (tensor)."""
+        if isinstance(logits, torch.Tensor):
+            return logits
+        # Pack into a typed float buffer in C, then wrap it without a per-element copy
+        # (much faster than torch.tensor on a ~150k-element Python list)
+        buffer = array('f', logits)
+        return torch.frombuffer(buffer, dtype=torch.float32).to(self.device)
+    
+    def topk(self, logits: Union[List[float], torch.Tensor], k: int) -> List[TokenInfo]:
         """
         Get top-k tokens from logits.
         
         Returns list sorted descending by probability.
         Probabilities sum to ~1 over full vocabulary.
         
-        Uses log_softmax for numerical stability, keeps everything as tensors until the end.
+        Uses log-sum-exp for numerical stability, keeps everything as tensors until the end.
         
         Clamps k to [5, 30] in the adapter.
         """
+        return self.topk_with_coverage(logits, k)[0]
+    
+    def topk_with_coverage(
+        self,
+        logits: Union[List[float], torch.Tensor],
+        k: int
+    ) -> Tuple[List[TokenInfo], float]:
+        """
+        Get top-k tokens (see topk) together with coverage_topk = Σ prob.
+        
+        The coverage is reduced on the tensor in the same pass that produced
+        the top-k probabilities, so callers don't sum the dicts in Python.
+        """
         # Clamp k to [5, 30] in the adapter
         k = max(self.TOP_K_MIN, min(self.TOP_K_MAX, k))
         
         # Convert to tensor once - keep as tensor until the very end
-        logits_tensor = torch.tensor(logits, dtype=torch.float32)
-        
-        # Compute log_probs using log_softmax (numerically stable)
-        log_probs = torch.log_softmax(logits_tensor, dim=-1)
+        logits_tensor = self._as_logits_tensor(logits)
         
-        # Get top-k directly from log_probs (more efficient)
-        topk_log_probs, topk_ids = torch.topk(log_probs, k, dim=-1)
+        # log_softmax is monotonic, so top-k of the raw logits picks the same ids.
+        # Select first, then normalize only the k values with the log-sum-exp
+        # constant instead of materializing a vocab-sized log_probs tensor.
+        topk_logits, topk_ids = torch.topk(logits_tensor, k, dim=-1)
+        log_normalizer = torch.logsumexp(logits_tensor, dim=-1)
+        topk_log_probs = topk_logits - log_normalizer
+        coverage_topk = torch.exp(topk_log_probs).sum().item()
         
-        # Convert to Python/JSON only at the very end
+        return self._topk_entries(topk_ids, topk_log_probs), coverage_topk
+    
+    def _topk_entries(self, topk_ids: torch.Tensor, topk_log_probs: torch.Tensor) -> List[TokenInfo]:
+        """Build the top-k TokenInfo list from descending top-k ids and log-probs."""
+        # Convert to Python/JSON only at the very end (one bulk conversion each)
+        ids_list = topk_ids.tolist()
+        logprobs_list = topk_log_probs.tolist()
         result = []
-        for i in range(k):
-            token_id = int(topk_ids[i].item())
-            # Get exact token string using convert_ids_to_tokens (preserves token semantics)
-            token_obj = self.tokenizer.convert_ids_to_tokens([token_id])[0]
-            # Use decode with clean_up_tokenization_spaces=False for raw text
-            token_text_raw = self.tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
-            # Create display version
-            token_text_display = make_token_display(token_text_raw)
-            
-            # Convert logprob and prob at the very end
-            logprob = float(topk_log_probs[i].item())
-            prob = float(torch.exp(topk_log_probs[i]).item())
+        for token_id, logprob in zip(ids_list, logprobs_list):
+            # Raw and display text come from the precomputed per-vocab cache
+            token_text_raw, token_text_display = self._token_text(token_id)
+            prob = math.exp(logprob)
             
             result.append({
                 "token_id": token_id,
@@ -211,17 +835,14 @@ class HuggingFaceAdapter(Adapter):
                 "logprob": logprob
             })
         
-        # Sort by prob desc (should already be sorted from topk, but ensure)
-        result.sort(key=lambda x: x["prob"], reverse=True)
-        
-        # Note: coverage_topk = Σ prob is calculated by the caller (main.py)
-        # This method returns the sorted list of top-k items
+        # No re-sort needed: torch.topk (sorted=True by default) already returns
+        # descending order, and the loop above preserves it
         
         return result
     
     def choose(
         self,
-        logits: List[float],
+        logits: Union[List[float], torch.Tensor],
         mode: Literal["argmax", "stochastic"],
         k: int,
         temperature: Optional[float] = None,
@@ -233,7 +854,7 @@ class HuggingFaceAdapter(Adapter):
         MVP: argmax over full vocab (not just within top-k).
         Returns same fields: {token_id, token_text, prob, logprob}
         
-        Uses log_softmax for numerical stability, keeps everything as tensors until the end.
+        Uses log-sum-exp for numerical stability, keeps everything as tensors until the end.
         
         Clamps k to [5, 30] in the adapter (for future stochastic mode).
         """
@@ -241,98 +862,158 @@ class HuggingFaceAdapter(Adapter):
         k = max(self.TOP_K_MIN, min(self.TOP_K_MAX, k))
         
         # Convert to tensor once - keep as tensor until the very end
-        logits_tensor = torch.tensor(logits, dtype=torch.float32)
-        
-        # Compute log_probs using log_softmax (numerically stable)
-        log_probs = torch.log_softmax(logits_tensor, dim=-1)
+        logits_tensor = self._as_logits_tensor(logits)
         
         if mode == "argmax":
             # MVP: argmax over full vocab (not just within top-k)
-            # Use argmax on log_probs (equivalent to argmax on probs, but more stable)
-            chosen_idx = torch.argmax(log_probs).item()
-            chosen_logprob = log_probs[chosen_idx].item()
-            
-            # Convert to Python/JSON only at the very end
-            token_id = int(chosen_idx)
-            # Get exact token string using convert_ids_to_tokens (preserves token semantics)
-            token_obj = self.tokenizer.convert_ids_to_tokens([token_id])[0]
-            # Use decode with clean_up_tokenization_spaces=False for raw text
-            token_text_raw = self.tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
-            # Create display version
-            token_text_display = make_token_display(token_text_raw)
-            
-            # Convert logprob and prob at the very end
-            logprob = float(chosen_logprob)
-            prob = float(math.exp(chosen_logprob))
-            # Compute surprisal = -log(prob + epsilon)
-            surprisal = float(-math.log(prob + 1e-12))
-            
-            return {
-                "token_id": token_id,
-                "token_text": token_text_raw,  # Keep for backward compatibility
-                "token_text_raw": token_text_raw,
-                "token_text_display": token_text_display,
-                "prob": prob,
-                "logprob": logprob,
-                "surprisal": surprisal
-            }
-        
+            # argmax on raw logits equals argmax on log_probs; normalize just the
+            # chosen value with log-sum-exp (numerically stable)
+            chosen_idx = torch.argmax(logits_tensor).item()
+            chosen_logprob = (logits_tensor[chosen_idx] - torch.logsumexp(logits_tensor, dim=-1)).item()
         elif mode == "stochastic":
-            # Stochastic sampling with temperature and top-p
-            # Start from last logits
-            logits_scaled = logits_tensor / (temperature if temperature is not None and temperature > 0 else 1.0)
-            
-            # Convert to probs
-            probs = torch.softmax(logits_scaled, dim=-1)
-            
-            # Apply nucleus (top-p) filter if specified
-            if top_p is not None and top_p < 1.0:
-                # Sort probabilities in descending order
-                sorted_probs, sorted_indices = torch.sort(probs, descending=True)
-                # Compute cumulative probabilities
-                cumsum_probs = torch.cumsum(sorted_probs, dim=-1)
-                # Find the smallest set with cumulative >= top_p
-                # Create a mask for tokens to keep
-                mask = cumsum_probs <= top_p
-                # Always keep at least the top token
-                if not mask.any():
-                    mask[0] = True
-                # Create full mask for original indices
-                filtered_probs = torch.zeros_like(probs)
-                filtered_probs[sorted_indices[mask]] = sorted_probs[mask]
-                # Renormalize
-                filtered_probs = filtered_probs / filtered_probs.sum()
-                probs = filtered_probs
-            
-            # Sample 1 token from the distribution
-            chosen_idx = torch.multinomial(probs, num_samples=1).item()
-            chosen_prob = probs[chosen_idx].item()
-            chosen_logprob = torch.log(probs[chosen_idx] + 1e-10).item()  # Add small epsilon for numerical stability
-            
-            # Convert to Python/JSON only at the very end
-            token_id = int(chosen_idx)
-            # Get exact token string using convert_ids_to_tokens (preserves token semantics)
-            token_obj = self.tokenizer.convert_ids_to_tokens([token_id])[0]
-            # Use decode with clean_up_tokenization_spaces=False for raw text
-            token_text_raw = self.tokenizer.decode([token_id], clean_up_tokenization_spaces=False)
-            # Create display version
-            token_text_display = make_token_display(token_text_raw)
-            
-            # Compute surprisal = -log(prob + epsilon)
-            surprisal = float(-math.log(chosen_prob + 1e-12))
-            
-            return {
-                "token_id": token_id,
-                "token_text": token_text_raw,  # Keep for backward compatibility
-                "token_text_raw": token_text_raw,
-                "token_text_display": token_text_display,
-                "prob": float(chosen_prob),
-                "logprob": float(chosen_logprob),
-                "surprisal": surprisal
-            }
-        
+            chosen_idx, chosen_logprob = self._sample(logits_tensor, temperature, top_p)
         else:
             raise ValueError(f"Unsupported mode: {mode}")
+        
+        return self._chosen_entry(chosen_idx, chosen_logprob)
+    
+    def step(
+        self,
+        logits: Union[List[float], torch.Tensor],
+        mode: Literal["argmax", "stochastic"],
+        k: int,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None
+    ) -> Tuple[List[TokenInfo], float, ChosenToken, bool]:
+        """
+        topk_with_coverage + choose in one pass over the logits.
+        
+        Returns (topk, coverage_topk, chosen, chosen_in_topk): the same values
+        as calling topk_with_coverage(logits, k) and choose(logits, mode, k, ...),
+        plus whether chosen is one of the topk entries, but with a single top-k
+        selection and full-vocab log-sum-exp: argmax is the first top-k entry,
+        and stochastic mode starts its nucleus search from the same top-k window.
+        """
+        # Clamp k to [5, 30] in the adapter
+        k = max(self.TOP_K_MIN, min(self.TOP_K_MAX, k))
+        if mode not in ("argmax", "stochastic"):
+            raise ValueError(f"Unsupported mode: {mode}")
+        
+        # Convert to tensor once - keep as tensor until the very end
+        logits_tensor = self._as_logits_tensor(logits)
+        
+        # Select enough for the display top-k and the first nucleus window
+        window = k if mode == "argmax" else max(k, self.NUCLEUS_WINDOW)
+        sorted_logits, sorted_ids = torch.topk(logits_tensor, min(window, logits_tensor.numel()), dim=-1)
+        log_normalizer = torch.logsumexp(logits_tensor, dim=-1)
+        topk_log_probs = sorted_logits[:k] - log_normalizer
+        coverage_topk = torch.exp(topk_log_probs).sum().item()
+        topk = self._topk_entries(sorted_ids[:k], topk_log_probs)
+        
+        if mode == "argmax":
+            # The argmax is the first top-k entry
+            chosen = self._chosen_entry(topk[0]["token_id"], topk[0]["logprob"])
+            chosen_in_topk = True
+        else:
+            chosen_idx, chosen_logprob = self._sample(
+                logits_tensor, temperature, top_p, window=(sorted_logits, sorted_ids)
+            )
+            chosen = self._chosen_entry(chosen_idx, chosen_logprob)
+            # Compare against the k-th largest logit instead of scanning the ids;
+            # only a tie with it needs the id check
+            chosen_logit = logits_tensor[chosen_idx].item()
+            kth_logit = sorted_logits[len(topk) - 1].item()
+            if chosen_logit != kth_logit:
+                chosen_in_topk = chosen_logit > kth_logit
+            else:
+                chosen_in_topk = any(token["token_id"] == chosen_idx for token in topk)
+        
+        return topk, coverage_topk, chosen, chosen_in_topk
+    
+    def _sample(
+        self,
+        logits_tensor: torch.Tensor,
+        temperature: Optional[float],
+        top_p: Optional[float],
+        window: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+    ) -> Tuple[int, float]:
+        """
+        Sample a token id with temperature and top-p; returns (token_id, logprob).
+        
+        window: optional (values, ids) of the top raw logits in descending
+        order, reused as the first nucleus window (temperature scaling keeps
+        the order).
+        """
+        # Stochastic sampling with temperature and top-p
+        # Start from last logits
+        scale = temperature if temperature is not None and temperature > 0 else 1.0
+        logits_scaled = logits_tensor / scale
+        
+        log_normalizer = torch.logsumexp(logits_scaled, dim=-1)
+        # Candidates to sample from: the full vocab unless top-p trims it
+        candidate_ids = None
+        candidate_logits = logits_scaled
+        
+        # Apply nucleus (top-p) filter if specified
+        if top_p is not None and top_p < 1.0:
+            # Partial selection instead of a full-vocab softmax + sort: take the
+            # top NUCLEUS_WINDOW scaled logits in descending order, exponentiate
+            # only those against the full-vocab normalizer, and widen the window
+            # until it holds the whole nucleus (or the whole vocab)
+            vocab = logits_scaled.numel()
+            if window is not None:
+                sorted_logits, sorted_indices = window[0] / scale, window[1]
+                size = sorted_logits.numel()
+            else:
+                size = min(self.NUCLEUS_WINDOW, vocab)
+                sorted_logits, sorted_indices = torch.topk(logits_scaled, size)
+            while True:
+                # Compute cumulative probabilities
+                cumsum_probs = torch.cumsum(torch.exp(sorted_logits - log_normalizer), dim=-1)
+                if size == vocab or cumsum_probs[-1].item() > top_p:
+                    break
+                size = min(size * 4, vocab)
+                sorted_logits, sorted_indices = torch.topk(logits_scaled, size)
+            # Keep the leading tokens with cumulative prob <= top_p (always at least
+            # the top token); searchsorted finds the cutoff without a vocab-sized mask
+            top_p_tensor = torch.tensor([top_p], dtype=cumsum_probs.dtype, device=cumsum_probs.device)
+            cutoff = max(1, int(torch.searchsorted(cumsum_probs, top_p_tensor, right=True).item()))
+            candidate_ids = sorted_indices[:cutoff]
+            # The window already holds the candidates' logits - no gather needed
+            candidate_logits = sorted_logits[:cutoff]
+            # Renormalize over the kept probability mass
+            log_normalizer = log_normalizer + torch.log(cumsum_probs[cutoff - 1])
+        
+        # Sample 1 token with the Gumbel-max trick: argmax(logits + Gumbel noise) is an
+        # exact sample from their softmax - one fused reduction instead of
+        # renormalize + multinomial. -log(Exp(1)) is Gumbel(0, 1) noise.
+        perturbed = candidate_logits - torch.log(torch.empty_like(candidate_logits).exponential_())
+        local_idx = torch.argmax(perturbed).item()
+        chosen_idx = local_idx if candidate_ids is None else candidate_ids[local_idx].item()
+        chosen_logprob = (candidate_logits[local_idx] - log_normalizer).item()
+        return chosen_idx, chosen_logprob
+    
+    def _chosen_entry(self, token_id: int, logprob: float) -> ChosenToken:
+        """Build the ChosenToken dict for a chosen id and its log-prob."""
+        # Convert to Python/JSON only at the very end
+        token_id = int(token_id)
+        # Raw and display text come from the precomputed per-vocab cache
+        token_text_raw, token_text_display = self._token_text(token_id)
+        
+        logprob = float(logprob)
+        prob = float(math.exp(logprob))
+        # Compute surprisal = -log(prob + epsilon)
+        surprisal = float(-math.log(prob + 1e-12))
+        
+        return {
+            "token_id": token_id,
+            "token_text": token_text_raw,  # Keep for backward compatibility
+            "token_text_raw": token_text_raw,
+            "token_text_display": token_text_display,
+            "prob": prob,
+            "logprob": logprob,
+            "surprisal": surprisal
+        }
     
     @property
     def vocab_size(self) -> int:
@@ -0,0 +1,142 @@
+"""
+Dynamic Request Batching
+
+Coalesces forward passes from concurrent API requests into one padded batch.
+"""
+import asyncio
+from concurrent.futures import Executor
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+from adapter_hf import HuggingFaceAdapter
+
+
+# (context ids, soften_newline_eot, future for the logits row)
+_Pending = Tuple[List[int], bool, asyncio.Future]
+
+
+class DynamicBatcher:
+    """
+    Batches adapter forward passes across concurrent requests.
+    
+    The first queued request opens a window of max_wait_ms; everything that
+    arrives within it (up to max_batch_size) is collected. Requests with a
+    cached KV prefix (e.g. a user stepping on) run one by one through
+    adapter.forward_last_tensor, which only feeds their new tokens; the cold
+    prefills run through a single adapter.forward_last_batch call (or
+    forward_last_tensor when there is only one).
+    
+    Forward passes run on `executor` (a single dedicated inference thread),
+    so the event loop keeps serving other requests and /healthz meanwhile.
+    Requests queued while a batch is running join the next batch.
+    """
+    
+    def __init__(
+        self,
+        adapter: HuggingFaceAdapter,
+        executor: Executor,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0
+    ):
+        self.adapter = adapter
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    def start(self) -> None:
+        """Start the background worker (call from within the running event loop)."""
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+    
+    async def stop(self) -> None:
+        """Cancel the background worker."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+    
+    async def submit(self, ids: List[int], soften_newline_eot: bool = False) -> torch.Tensor:
+        """
+        Queue one forward pass and wait for its last-position logits.
+        
+        Returns the same 1-D float32 tensor as adapter.forward_last_tensor.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((ids, soften_newline_eot, future))
+        return await future
+    
+    async def _run(self) -> None:
+        """Collect requests for up to max_wait_ms (or a full batch), then run them."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_s
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._process(batch)
+    
+    async def _process(self, batch: List[_Pending]) -> None:
+        """Run one batch on the inference thread and resolve each request's future."""
+        # Skip requests whose caller already went away
+        batch = [pending for pending in batch if not pending[2].done()]
+        if not batch:
+            return
+        
+        # asyncio futures aren't thread-safe: compute on the executor, resolve here
+        requests = [(ids, soften) for ids, soften, _ in batch]
+        results = await asyncio.get_running_loop().run_in_executor(self.executor, self._forward, requests)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    def _forward(self, requests: List[Tuple[List[int], bool]]) -> List[Union[torch.Tensor, Exception]]:
+        """Run the forward pass(es) for one batch (called on the inference thread)."""
+        results: List[Union[torch.Tensor, Exception, None]] = [None] * len(requests)
+        # Warm requests first: a batched prefill would redo their cached prefix
+        cold = []
+        for index, (ids, soften) in enumerate(requests):
+            if self.adapter.has_cached_prefix(ids):
+                results[index] = self._forward_one(ids, soften)
+            else:
+                cold.append(index)
+        
+        if len(cold) > 1:
+            try:
+                logits = self.adapter.forward_last_batch(
+                    [requests[index][0] for index in cold],
+                    [requests[index][1] for index in cold]
+                )
+            except Exception:
+                # Fall through to one-by-one so a bad input only fails its own request
+                pass
+            else:
+                for row, index in enumerate(cold):
+                    results[index] = logits[row]
+                return results
+        
+        for index in cold:
+            results[index] = self._forward_one(*requests[index])
+        return results
+    
+    def _forward_one(self, ids: List[int], soften: bool) -> Union[torch.Tensor, Exception]:
+        """adapter.forward_last_tensor for one request, returning its exception instead of raising."""
+        try:
+            return self.adapter.forward_last_tensor(ids, soften)
+        except Exception as e:
+            return e
@@ -3,25 +3,95 @@ NextWord API Server
 
 FastAPI server implementing the frozen API contracts.
 """
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import torch
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Literal
 
 from contracts import (
     TokenInfo,
     ChosenToken,
-    ModelInfo,
-    LastToken,
     NextDistRequest,
     NextDistResponse,
     StepRequest,
     StepResponse
 )
 from adapter_hf import HuggingFaceAdapter
+from batcher import DynamicBatcher
 
-app = FastAPI(title="NextWord API", version="1.0.0")
+# orjson encodes the float-heavy top-k payloads much faster than stdlib json
+app = FastAPI(title="NextWord API", version="1.0.0", default_response_class=ORJSONResponse)
+
+class ContractVersionHeaderMiddleware:
+    """
+    Add the contract version header to all responses.
+    
+    Pure ASGI middleware: the constant header is appended to the
+    http.response.start message, without the call_next wrapping (extra task
+    and response re-streaming) of an @app.middleware("http") function.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        async def send_with_header(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), CONTRACT_VERSION_HEADER]
+            await send(message)
+        
+        await self.app(scope, receive, send_with_header)
+
+
+def _payload_too_large_response() -> ORJSONResponse:
+    """413 error for context_text over MAX_PAYLOAD_SIZE characters."""
+    return ORJSONResponse(
+        status_code=413,
+        content={
+            "status": "error",
+            "message": f"Input too large (max {MAX_PAYLOAD_SIZE} characters)",
+            "hint": "Reduce the size of your context_text input"
+        }
+    )
+
+
+class PayloadSizeLimitMiddleware:
+    """
+    Reject oversized request bodies by Content-Length before they are read.
+    
+    Paste bombs get a 413 without the body ever being parsed into a string.
+    Smaller bodies (and ones without a Content-Length header) can still carry
+    too long a context_text; its max_length error is mapped to the same 413
+    by validation_exception_handler.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_REQUEST_BYTES:
+                        await _payload_too_large_response()(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+
+# Reject oversized bodies first (innermost, so the 413 still gets CORS headers)
+app.add_middleware(PayloadSizeLimitMiddleware)
 
 # CORS middleware for client access (enable for localhost:3000 and 3001 during dev)
 app.add_middleware(
@@ -32,18 +102,14 @@ app.add_middleware(
     allow_headers=["Content-Type"],  # Only Content-Type header
 )
 
-# Add contract version header to all responses
-@app.middleware("http")
-async def add_contract_version_header(request: Request, call_next):
-    response = await call_next(request)
-    response.headers["X-NextTokenLens-Contract"] = CONTRACT_VERSION
-    return response
+# Add contract version header to all responses (outermost, so CORS preflights get it too)
+app.add_middleware(ContractVersionHeaderMiddleware)
 
 # Global exception handler for unhandled exceptions
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Handle unhandled exceptions and return error format."""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={
             "status": "error",
@@ -52,8 +118,24 @@ async def global_exception_handler(request: Request, exc: Exception):
         }
     )
 
-# Global adapter instance (initialize on startup)
+# Over-long context_text within the byte cap: same 413 as PayloadSizeLimitMiddleware
+# instead of the default 422; other validation errors keep FastAPI's 422
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    """Map a context_text max_length violation to the 413 error format."""
+    if any(
+        error["type"] == "string_too_long" and error["loc"][-1] == "context_text"
+        for error in exc.errors()
+    ):
+        return _payload_too_large_response()
+    return await request_validation_exception_handler(request, exc)
+
+# Global adapter, request batcher and inference thread (initialize on startup)
 adapter: Optional[HuggingFaceAdapter] = None
+batcher: Optional[DynamicBatcher] = None
+inference_executor: Optional[ThreadPoolExecutor] = None
+inference_slots: Optional[asyncio.Semaphore] = None  # Admission control for forward passes
+model_info_model: Optional["ModelInfoModel"] = None  # Shared by every response (model is fixed)
 MODEL_NAME = "Qwen/Qwen2.5-1.5B"  # Qwen2.5-1.5B model
 
 # Performance defaults
@@ -63,21 +145,73 @@ TOP_K_MIN = 5  # Minimum top-k (server clamps to this)
 TOP_K_MAX = 30  # Maximum top-k (server clamps to this)
 THROUGHPUT_TARGET_MS = 400  # Target: ≤ 400ms per Step
 MAX_PAYLOAD_SIZE = 50000  # Max payload size in chars (prevent paste bombs)
+MAX_REQUEST_BYTES = MAX_PAYLOAD_SIZE * 12 + 1024  # Body cap: a JSON-escaped astral char (\ud83d\ude00) is 12 bytes
+MAX_BATCH_SIZE = 8  # Max concurrent requests coalesced into one forward pass
+MAX_WAIT_MS = 10  # How long the batcher waits for more requests to join a batch
+MAX_INFLIGHT = MAX_BATCH_SIZE * 2  # Forward passes admitted at once (one batch running, one filling)
+ADMISSION_TIMEOUT_S = 0.05  # How long a request waits for a slot before getting 429
+COMPILE_MODEL = os.environ.get("NEXTWORD_COMPILE") == "1"  # Opt-in torch.compile (slow startup)
+MODEL_DEVICE = os.environ.get("NEXTWORD_DEVICE", "cpu")  # "cpu" or "cuda" / "cuda:N"
+MODEL_DTYPE = os.environ.get("NEXTWORD_DTYPE", "auto")  # auto | float32 | bfloat16 | float16
+MODEL_QUANTIZE = os.environ.get("NEXTWORD_QUANTIZE") or None  # "int8", "int4" or unset
+USE_IPEX = os.environ.get("NEXTWORD_IPEX") == "1"  # Opt-in Intel Extension for PyTorch (CPU)
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS") or os.cpu_count() or 1)  # Intra-op threads per forward pass
 
 # Contract version
 CONTRACT_VERSION = "v1"
+CONTRACT_VERSION_HEADER = (b"x-nexttokenlens-contract", CONTRACT_VERSION.encode("latin-1"))  # Raw ASGI header
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize the adapter on startup."""
-    global adapter
+    """Initialize the adapter, inference thread and request batcher on startup."""
+    global adapter, batcher, inference_executor, inference_slots, model_info_model
+    # Forward passes run one at a time on the inference thread: give each one
+    # all intra-op threads, and no separate inter-op pool to oversubscribe cores
+    torch.set_num_threads(TORCH_THREADS)
     try:
-        adapter = HuggingFaceAdapter(MODEL_NAME, device="cpu")
+        torch.set_num_interop_threads(1)
+    except RuntimeError as e:
+        # Only allowed before any inter-op parallel work has started
+        print(f"Could not set inter-op threads: {e}")
+    try:
+        adapter = HuggingFaceAdapter(
+            MODEL_NAME,
+            device=MODEL_DEVICE,
+            compile_model=COMPILE_MODEL,
+            dtype=MODEL_DTYPE,
+            quantize=MODEL_QUANTIZE,
+            use_ipex=USE_IPEX
+        )
         print(f"Loaded model: {MODEL_NAME}")
     except Exception as e:
         print(f"Error loading model: {e}")
         raise
+    # Minimal model_info, identical for every response
+    model_info_model = ModelInfoModel(
+        provider="hf-local",
+        model_name=adapter.model_name,
+        vocab_size=adapter.vocab_size
+    )
+    # One dedicated thread runs every forward pass, keeping the event loop free
+    inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+    batcher = DynamicBatcher(
+        adapter,
+        inference_executor,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=MAX_WAIT_MS
+    )
+    batcher.start()
+    inference_slots = asyncio.Semaphore(MAX_INFLIGHT)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the request batcher and the inference thread."""
+    if batcher is not None:
+        await batcher.stop()
+    if inference_executor is not None:
+        inference_executor.shutdown(wait=True)
 
 
 # Pydantic models for request/response validation
@@ -146,86 +280,69 @@ async def next_dist(request: NextDistRequestModel):
     Request: { "context_text": string, "top_k": number }
     Response: Same fields as /step minus chosen and append_text.
     """
-    if adapter is None:
-        return JSONResponse(
+    if adapter is None or batcher is None:
+        return ORJSONResponse(
             status_code=500,
             content={"status": "error", "message": "Adapter not initialized", "hint": "Server startup may have failed"}
         )
     
     try:
-        # Validation: reject empty top_k or huge inputs
-        if request.top_k is None or request.top_k < 1:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "status": "error",
-                    "message": "top_k must be a positive integer",
-                    "hint": "Provide a top_k value between 1 and 30 (will be clamped to [5, 30])"
-                }
-            )
-        
-        if len(request.context_text) > MAX_PAYLOAD_SIZE:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "status": "error",
-                    "message": f"Input too large (max {MAX_PAYLOAD_SIZE} characters)",
-                    "hint": "Reduce the size of your context_text input"
-                }
-            )
-        
-        # Clamp top_k to [5, 30]
+        # Clamp top_k to [5, 30] (top_k >= 1 is enforced by the request model)
         clamped_top_k = max(TOP_K_MIN, min(TOP_K_MAX, request.top_k))
         
         # Handle empty context (BOS) - allow empty string
         context_text = request.context_text if request.context_text else ""
         
-        # Tokenize context_text; truncate to last 512 IDs (done in adapter.tokenize)
-        tokenize_result = adapter.tokenize(context_text)
-        context_ids = tokenize_result["ids"]
-        context_tokens = tokenize_result["tokens"]
+        # Tokenize context_text; truncate to last 512 IDs (done in the adapter)
+        # Only the last token's text is used, so skip building the full token list
+        context_ids, last_token_id, last_token_text = adapter.tokenize_last(context_text)
         
         # Compute context_len_tokens (after truncation in adapter)
         context_len = len(context_ids)
         
-        # Run forward; get last logits → probs
-        logits = adapter.forward_last(context_ids, soften_newline_eot=False)  # /next_dist doesn't support this toggle
-        
-        # Build topk (k clamped to [5, 30])
-        topk = adapter.topk(logits, clamped_top_k)
-        
-        # Calculate coverage_topk (sum of top-k probabilities)
-        coverage_topk = sum(token["prob"] for token in topk)
-        
-        # last_token: if context had ≥1 token, set {id, text} to the final context token; otherwise null
-        last_token: LastToken = {
-            "id": context_ids[-1] if context_ids else None,
-            "text": context_tokens[-1] if context_tokens else None
-        }
+        # Run forward (batched with concurrent requests); get last logits → probs
+        # Admission control: under overload, rejecting fast beats queueing past
+        # the step time budget
+        try:
+            await asyncio.wait_for(inference_slots.acquire(), timeout=ADMISSION_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            return ORJSONResponse(
+                status_code=429,
+                content={
+                    "status": "error",
+                    "message": "Server busy",
+                    "hint": "Too many requests in flight; retry shortly"
+                }
+            )
+        try:
+            logits = await batcher.submit(context_ids, soften_newline_eot=False)  # /next_dist doesn't support this toggle
+        finally:
+            inference_slots.release()
         
-        # Include minimal model_info
-        model_info: ModelInfo = {
-            "provider": "hf-local",
-            "model_name": adapter.model_name,
-            "vocab_size": adapter.vocab_size
-        }
+        # Build topk (k clamped to [5, 30]) and coverage_topk (sum of top-k probabilities)
+        topk, coverage_topk = adapter.topk_with_coverage(logits, clamped_top_k)
         
-        return NextDistResponseModel(
-            contract_version=CONTRACT_VERSION,
+        # Adapter output is already well-typed: build the response without
+        # re-validating it, and return it directly so FastAPI doesn't validate
+        # it a second time against response_model (contract_version comes from
+        # the model default)
+        response = NextDistResponseModel.model_construct(
             context_len_tokens=context_len,
-            topk=[TokenInfoModel(**token) for token in topk],
+            topk=[TokenInfoModel.model_construct(**token) for token in topk],
             coverage_topk=coverage_topk,
-            last_token=LastTokenModel(**last_token),
-            model_info=ModelInfoModel(**model_info)
+            # last_token: the final context token's {id, text}; both null for an empty context
+            last_token=LastTokenModel.model_construct(id=last_token_id, text=last_token_text),
+            model_info=model_info_model  # Constant per model, built at startup
         )
+        return ORJSONResponse(content=response.model_dump())
     
     except ValueError as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": str(e), "hint": "Check your input parameters"}
         )
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"status": "error", "message": str(e), "hint": "Internal server error occurred"}
         )
@@ -249,108 +366,87 @@ async def step(request: StepRequestModel):
     5. last_token: if context had ≥1 token, set {id, text} to the final context token; otherwise null
     6. append_text is exact decoded token for chosen.token_id
     """
-    if adapter is None:
-        return JSONResponse(
+    if adapter is None or batcher is None:
+        return ORJSONResponse(
             status_code=500,
             content={"status": "error", "message": "Adapter not initialized", "hint": "Server startup may have failed"}
         )
     
     try:
-        # Validation: reject empty top_k or huge inputs
-        if request.top_k is None or request.top_k < 1:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "status": "error",
-                    "message": "top_k must be a positive integer",
-                    "hint": "Provide a top_k value between 1 and 30 (will be clamped to [5, 30])"
-                }
-            )
-        
-        if len(request.context_text) > MAX_PAYLOAD_SIZE:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "status": "error",
-                    "message": f"Input too large (max {MAX_PAYLOAD_SIZE} characters)",
-                    "hint": "Reduce the size of your context_text input"
-                }
-            )
-        
-        # Clamp top_k to [5, 30]
+        # Clamp top_k to [5, 30] (top_k >= 1 is enforced by the request model)
         clamped_top_k = max(TOP_K_MIN, min(TOP_K_MAX, request.top_k))
         used_top_k = clamped_top_k
         
         # Handle empty context (BOS) - allow empty string
         context_text = request.context_text if request.context_text else ""
         
-        # 1. Tokenize context_text; truncate to last 512 IDs (done in adapter.tokenize)
-        tokenize_result = adapter.tokenize(context_text)
-        context_ids = tokenize_result["ids"]
-        context_tokens = tokenize_result["tokens"]
+        # 1. Tokenize context_text; truncate to last 512 IDs (done in the adapter)
+        # Only the last token's text is used, so skip building the full token list
+        context_ids, last_token_id, last_token_text = adapter.tokenize_last(context_text)
         
         # Compute context_len_tokens (after truncation in adapter)
         context_len = len(context_ids)
         
-        # 2. Run forward; get last logits → probs
-        logits = adapter.forward_last(context_ids, soften_newline_eot=request.soften_newline_eot)
+        # 2. Run forward (batched with concurrent requests); get last logits → probs
+        # Admission control (see /next_dist)
+        try:
+            await asyncio.wait_for(inference_slots.acquire(), timeout=ADMISSION_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            return ORJSONResponse(
+                status_code=429,
+                content={
+                    "status": "error",
+                    "message": "Server busy",
+                    "hint": "Too many requests in flight; retry shortly"
+                }
+            )
+        try:
+            logits = await batcher.submit(context_ids, soften_newline_eot=request.soften_newline_eot)
+        finally:
+            inference_slots.release()
         
         # 3. Build topk (k clamped to [5, 30])
         # Note: topk is from unfiltered distribution (for pedagogical chart)
-        topk = adapter.topk(logits, clamped_top_k)
-        
-        # Choose token (argmax or stochastic with temperature and top-p)
-        chosen = adapter.choose(
-            logits, 
-            request.mode, 
+        # Choose token (argmax or stochastic with temperature and top-p) in the
+        # same pass: one top-k selection and log-sum-exp over the logits
+        topk, coverage_topk, chosen, chosen_in_topk = adapter.step(
+            logits,
+            request.mode,
             clamped_top_k,
             temperature=request.temperature if request.mode == "stochastic" else None,
             top_p=request.top_p if request.mode == "stochastic" else None
         )
         
-        # Ensure chosen appears in topk: if argmax isn't in top-k, insert it and drop the last entry
-        chosen_in_topk = any(t["token_id"] == chosen["token_id"] for t in topk)
+        # Ensure chosen appears in topk: if it isn't in top-k, insert it and drop the last entry
         if not chosen_in_topk:
+            # coverage_topk (sum of top-k probabilities) follows the swapped entries
+            coverage_topk += chosen["prob"] - topk[-1]["prob"]
             topk = [chosen] + topk[:-1]  # Insert chosen at front, drop last to keep length k
         
-        # Calculate coverage_topk (sum of top-k probabilities)
-        coverage_topk = sum(token["prob"] for token in topk)
-        
-        # last_token: if context had ≥1 token, set {id, text} to the final context token; otherwise null
-        last_token: LastToken = {
-            "id": context_ids[-1] if context_ids else None,
-            "text": context_tokens[-1] if context_tokens else None
-        }
-        
-        # Include minimal model_info
-        model_info: ModelInfo = {
-            "provider": "hf-local",
-            "model_name": adapter.model_name,
-            "vocab_size": adapter.vocab_size
-        }
-        
         # append_text is exact decoded token for chosen.token_id (use raw token)
         append_text = chosen.get("token_text_raw", chosen["token_text"])
         
-        return StepResponseModel(
-            contract_version=CONTRACT_VERSION,
+        # Build without re-validation and bypass response_model validation (see /next_dist)
+        response = StepResponseModel.model_construct(
             context_len_tokens=context_len,
-            topk=[TokenInfoModel(**token) for token in topk],
+            topk=[TokenInfoModel.model_construct(**token) for token in topk],
             coverage_topk=coverage_topk,
-            last_token=LastTokenModel(**last_token),
-            model_info=ModelInfoModel(**model_info),
-            chosen=ChosenTokenModel(**chosen),
+            # last_token: the final context token's {id, text}; both null for an empty context
+            last_token=LastTokenModel.model_construct(id=last_token_id, text=last_token_text),
+            model_info=model_info_model,  # Constant per model, built at startup
+            chosen=ChosenTokenModel.model_construct(**chosen),
             append_text=append_text,
             used_top_k=used_top_k
         )
+        return ORJSONResponse(content=response.model_dump())
     
     except ValueError as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={"status": "error", "message": str(e), "hint": "Check your input parameters"}
         )
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={"status": "error", "message": str(e), "hint": "Internal server error occurred"}
         )
@@ -365,7 +461,7 @@ async def healthz():
     Model loads eagerly at startup so the first STEP isn't slow.
     """
     if adapter is None:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={
                 "status": "error",
@@ -17,6 +17,8 @@ if sys.platform == 'win32':
     sys.stderr = codecs.getwriter('utf-8')(sys.stderr.buffer, 'strict')
 
 API_BASE = "http://localhost:8000"
+# One pooled keep-alive session for every test call (no per-request TCP connect)
+SESSION = requests.Session()
 
 def test_health():
     """Test /healthz endpoint"""
@@ -24,7 +26,7 @@ def test_health():
     print("Test 1: Health Check")
     print("=" * 60)
     try:
-        response = requests.get(f"{API_BASE}/healthz", timeout=5)
+        response = SESSION.get(f"{API_BASE}/healthz", timeout=5)
         assert response.status_code == 200, f"Expected 200, got {response.status_code}"
         data = response.json()
         print(f"[PASS] Health check passed")
@@ -49,7 +51,7 @@ def test_empty_context():
     print("Test 2: Empty Context (BOS)")
     print("=" * 60)
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": "",
@@ -82,7 +84,7 @@ def test_short_prompt():
     print("=" * 60)
     try:
         prompt = "The capital of France is"
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": prompt,
@@ -137,7 +139,7 @@ def test_unicode_prompt():
     print("=" * 60)
     try:
         prompt = "Emoji test: 🔥 The"
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": prompt,
@@ -171,7 +173,7 @@ def test_truncation():
     try:
         # Create a very long prompt (should exceed 512 tokens)
         long_prompt = "The capital of France is " * 100  # ~2400 tokens
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": long_prompt,
@@ -200,7 +202,7 @@ def test_topk_clamping():
     print("=" * 60)
     try:
         # Test below minimum
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": "Test",
@@ -219,7 +221,7 @@ def test_topk_clamping():
         assert topk_count == 5, f"Expected 5 top-k items, got {topk_count}"
         
         # Test above maximum
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": "Test",
@@ -250,7 +252,7 @@ def test_multiple_steps():
     try:
         context = "The capital of France is"
         for i in range(3):
-            response = requests.post(
+            response = SESSION.post(
                 f"{API_BASE}/step",
                 json={
                     "context_text": context,
@@ -278,7 +280,7 @@ def test_response_structure():
     print("Test 8: Response Structure")
     print("=" * 60)
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": "Test",
@@ -330,7 +332,7 @@ def test_error_handling():
     try:
         # Test huge input
         huge_input = "x" * 60000  # Exceeds 50k limit
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE}/step",
             json={
                 "context_text": huge_input,
@@ -339,7 +341,7 @@ def test_error_handling():
             },
             timeout=30
         )
-        assert response.status_code == 400, f"Expected 400 for huge input, got {response.status_code}"
+        assert response.status_code == 413, f"Expected 413 for huge input, got {response.status_code}"
         data = response.json()
         assert data.get('status') == 'error', "Error response should have status='error'"
         assert 'message' in data, "Error response should have message"
@@ -351,6 +353,60 @@ def test_error_handling():
         print(f"[FAIL] Error handling test failed: {e}")
         return False
 
+def test_tokenize_cache():
+    """Test that cached tokenizations of appending contexts match cold requests"""
+    print("\n" + "=" * 60)
+    print("Test 10: Tokenization Cache")
+    print("=" * 60)
+    try:
+        # Grow texts a few characters at a time (the /step append pattern),
+        # including long single pre-tokens (CJK run, long word, URL, whitespace run)
+        sequences = [
+            "The capital of France is",
+            "你好世界，这是一个没有空格的很长的中文句子用来测试分词",
+            " supercalifragilisticexpialidocious internationalization",
+            " https://example.com/internationalization/path?query=value",
+            " x" + " " * 20 + "y",
+        ]
+        
+        def next_dist(text):
+            response = SESSION.post(
+                f"{API_BASE}/next_dist",
+                json={"context_text": text, "top_k": 5},
+                timeout=30
+            )
+            assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+            data = response.json()
+            return data["context_len_tokens"], data["last_token"]
+        
+        appended = {}
+        for sequence in sequences:
+            for end in range(3, len(sequence) + 1, 3):
+                text = sequence[:end]
+                appended[text] = next_dist(text)
+                # Repeat request: served from the server's tokenize cache
+                cached = next_dist(text)
+                assert cached == appended[text], f"Cached {cached} != {appended[text]} for {text!r}"
+        
+        # Evict the server's tokenize cache (128 texts) so the same texts are
+        # encoded from scratch
+        for i in range(130):
+            next_dist(f"evict {i}")
+        
+        # Longest text first with an unrelated request in between, so no cold
+        # request extends the one before it
+        for text, expected in reversed(list(appended.items())):
+            next_dist("unrelated")
+            cold = next_dist(text)
+            assert cold == expected, f"Appended {expected} != cold {cold} for {text!r}"
+        
+        print(f"[PASS] Tokenization cache test succeeded")
+        print(f"  {len(appended)} appended contexts match cold requests")
+        return True
+    except Exception as e:
+        print(f"[FAIL] Tokenization cache test failed: {e}")
+        return False
+
 def main():
     """Run all tests"""
     print("\n" + "=" * 60)
@@ -369,11 +425,12 @@ def main():
         ("Multiple Steps", test_multiple_steps),
         ("Response Structure", test_response_structure),
         ("Error Handling", test_error_handling),
+        ("Tokenization Cache", test_tokenize_cache),
     ]
     
     # First, check if backend is running
     try:
-        response = requests.get(f"{API_BASE}/healthz", timeout=2)
+        response = SESSION.get(f"{API_BASE}/healthz", timeout=2)
         if response.status_code != 200:
             print(f"[ERROR] Backend returned status {response.status_code}")
             return 1